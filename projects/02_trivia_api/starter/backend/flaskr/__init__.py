@@ -1,19 +1,128 @@
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, current_app, stream_with_context
 from flask_cors import CORS
-import random
+from flask_compress import Compress
+from hashlib import blake2b
+import orjson
+import time
+from sqlalchemy import Integer, all_, bindparam, func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import SQLAlchemyError
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 QUESTIONS_PER_PAGE = 10
-
-
-def paginate_questions(request, selection):
+# seconds a cached categories list (and the client copy) stays valid
+CATEGORIES_MAX_AGE = 60
+
+# columns selected through Core instead of loading ORM objects,
+# rows come back as mappings with the same keys as format()
+_QUESTION_COLS = (Question.id, Question.question, Question.answer,
+                  Question.category, Question.difficulty)
+_QUESTION_KEYS = tuple(col.key for col in _QUESTION_COLS)
+_CATEGORY_COLS = (Category.id, Category.type)
+
+# the categories (max(id), count(*)) signature as scalar subqueries,
+# selected next to a page of questions it lets get_questions check
+# the categories cache without a separate round-trip
+_CATEGORIES_SIGNATURE_COLS = (
+    select(func.max(Category.id)).scalar_subquery()
+    .label('categories_max_id'),
+    select(func.count(Category.id)).scalar_subquery()
+    .label('categories_count'))
+
+# page statements are built once, limit/offset (and the category) are
+# bind parameters, so every request reuses the same compiled SQL.
+# count(*) OVER () returns the total number of matches with the page
+_PAGE_STMT = select(*_QUESTION_COLS, func.count().over().label('total')) \
+    .order_by(Question.id) \
+    .limit(bindparam('page_limit')) \
+    .offset(bindparam('page_offset'))
+_QUESTIONS_PAGE_STMT = _PAGE_STMT.add_columns(*_CATEGORIES_SIGNATURE_COLS)
+_CATEGORY_PAGE_STMT = _PAGE_STMT \
+    .where(Question.category == bindparam('category'))
+
+# formatted categories and their ETag keyed by a cheap
+# (max(id), count(*)) signature, so the categories table
+# is only fully read when it changes size or the entry expires.
+# The expiry picks up edits like a renamed category type,
+# which leave the signature as it was
+_categories_cache = {}
+
+
+def jsonify(payload):
+    # Flask 2.0 has no pluggable JSON provider, so responses are
+    # serialized with orjson here instead of flask.jsonify
+    return current_app.response_class(orjson.dumps(payload),
+                                      mimetype='application/json')
+
+
+def paginate_questions(request, stmt, params=None):
     page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-    return current_questions
+    start = max(page - 1, 0) * QUESTIONS_PER_PAGE
+    # only the requested page is fetched from the database
+    rows = db.session.execute(stmt, {
+        'page_limit': QUESTIONS_PER_PAGE,
+        'page_offset': start,
+        **(params or {})
+    }).mappings().all()
+    current_questions = [{key: row[key] for key in _QUESTION_KEYS}
+                         for row in rows]
+    # other selected columns describe the whole page,
+    # they are returned once, taken from the first row
+    page_info = {key: value for key, value in rows[0].items()
+                 if key not in _QUESTION_KEYS} if rows else {}
+    return current_questions, page_info
+
+
+def stream_questions(stmt, categories_list):
+    # rows are read from a server-side cursor and written out one by one,
+    # so memory use does not grow with the number of questions
+    result = db.session.execute(
+        stmt.order_by(Question.id)
+            .execution_options(stream_results=True, max_row_buffer=100))
+    rows = iter(result.mappings())
+    first = next(rows, None)
+    if first is None:
+        abort(404)
+
+    def generate():
+        yield b'{"success":true,"questions":[' + orjson.dumps(dict(first))
+        total = 1
+        for row in rows:
+            yield b',' + orjson.dumps(dict(row))
+            total += 1
+        yield b'],"total_questions":' + str(total).encode() + \
+            b',"categories":' + orjson.dumps(categories_list) + \
+            b',"current_category":null}'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/json')
+
+
+def exclude_previous_questions(stmt, previous_questions):
+    # the ids are sent as a single array parameter (id != ALL(:ids)),
+    # so the statement and its cached compiled form are the same
+    # however many questions were already asked
+    previous = bindparam('previous_questions', list(previous_questions),
+                         type_=ARRAY(Integer))
+    return stmt.where(Question.id != all_(previous))
+
+
+def _get_categories_cached(signature=None):
+    if signature is None:
+        signature = tuple(db.session.query(func.max(Category.id),
+                                           func.count(Category.id)).one())
+    now = time.monotonic()
+    cached = _categories_cache.get(signature)
+    if cached is None or now - cached[2] >= CATEGORIES_MAX_AGE:
+        rows = db.session.execute(select(*_CATEGORY_COLS)).mappings().all()
+        categories_list = [dict(row) for row in rows]
+        etag = blake2b(orjson.dumps(categories_list),
+                       digest_size=8).hexdigest()
+        cached = (categories_list, etag, now)
+        _categories_cache.clear()
+        _categories_cache[signature] = cached
+    return cached[:2]
 
 
 def create_app(test_config=None):
@@ -21,17 +130,24 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
 
+    # question and category lists compress well, prefer brotli
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_BR_LEVEL'] = 4
+    app.config['COMPRESS_MIN_SIZE'] = 500
+    # compressing a stream would buffer the whole body first,
+    # streamed responses (page=all) are sent uncompressed
+    app.config['COMPRESS_STREAMS'] = False
+    Compress(app)
+
     '''
     to make it more secure '/api/' was added into the frontend paths
     '''
-    CORS(app, resources={r"/api/*": {"origins": "*"}})
+    CORS(app, resources={r"/api/*": {
+        "origins": "*",
+        "allow_headers": ["Content-Type"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"]
+    }})
 
-    @app.after_request
-    def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        response.headers.add('Access-Control-Allow-Methods',
-                             'GET,POST,DELETE,OPTIONS')
-        return response
     '''
     Create an endpoint to handle GET requests
     for all available categories.
@@ -39,15 +155,26 @@ def create_app(test_config=None):
 
     @app.route('/api/categories', methods=['GET'])
     def get_categories():
-        categories = Category.query.all()
-        categories_list = [category.format() for category in categories]
+        categories_list, etag = _get_categories_cached()
         if len(categories_list) == 0:
             abort(404)
 
-        return jsonify({
-            "success": True,
-            "categories": categories_list
-        })
+        # categories rarely change, let the client reuse its copy.
+        # Flask-Compress appends ":<algorithm>" to the ETag of a
+        # compressed response, those variants match as well
+        etags = [etag] + [f'{etag}:{algorithm}' for algorithm
+                          in current_app.config['COMPRESS_ALGORITHM']]
+        if any(request.if_none_match.contains_weak(candidate)
+               for candidate in etags):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify({
+                "success": True,
+                "categories": categories_list
+            })
+        response.set_etag(etag, weak=True)
+        response.cache_control.max_age = CATEGORIES_MAX_AGE
+        return response
 
     '''
     Create an endpoint to handle GET requests for questions,
@@ -64,19 +191,23 @@ def create_app(test_config=None):
 
     @app.route('/api/questions', methods=['GET'])
     def get_questions():
-        selection = Question.query.all()
-        current_questions = paginate_questions(request, selection)
+        if request.args.get('page') == 'all':
+            categories_list, _ = _get_categories_cached()
+            return stream_questions(select(*_QUESTION_COLS), categories_list)
+
+        current_questions, page_info = paginate_questions(
+            request, _QUESTIONS_PAGE_STMT)
 
         if len(current_questions) == 0:
             abort(404)
 
-        categories = Category.query.all()
-        categories_list = [category.format() for category in categories]
+        categories_list, _ = _get_categories_cached(
+            (page_info['categories_max_id'], page_info['categories_count']))
 
         return jsonify({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(selection),
+            'total_questions': page_info['total'],
             'categories': categories_list,
             'current_category': None
         })
@@ -90,18 +221,23 @@ def create_app(test_config=None):
     '''
     @app.route('/api/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
-        question = Question.query.get(question_id)
-        if question is None:
+        # delete in a single statement, the number of deleted rows
+        # tells whether the question existed
+        try:
+            deleted = Question.query.filter_by(id=question_id) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        if deleted == 0:
             abort(404)
-        else:
-            try:
-                question.delete()
-                return jsonify({
-                    "success": True,
-                    "deleted": question_id
-                  })
-            except:
-                abort(422)
+
+        return jsonify({
+            "success": True,
+            "deleted": question_id
+        })
 
     '''
     Create an endpoint to POST a new question,
@@ -124,20 +260,30 @@ def create_app(test_config=None):
     '''
     @app.route('/api/questions', methods=['POST'])
     def add_question():
-        content = request.get_json()
+        content = request.get_json(silent=True) or {}
+        if not isinstance(content, dict):
+            abort(400)
         if 'searchTerm' in content:
             # if request contains searchTerm than get any questions
             # for whom the search term is a substring of the question
             search_term = content['searchTerm']
+            if not isinstance(search_term, str):
+                abort(400)
             if len(search_term) > 1000:
                 abort(400)
 
-            questions = Question.query.filter(
-              Question.question.ilike(f'%{search_term}%')).all()
+            # wildcards typed by the user are matched literally
+            search_term = search_term.replace('\\', '\\\\') \
+                .replace('%', '\\%') \
+                .replace('_', '\\_')
+            questions = db.session.execute(
+              select(*_QUESTION_COLS).where(
+                Question.question.ilike(f'%{search_term}%', escape='\\'))
+            ).mappings().all()
 
-            questions_list = [question.format() for question in questions]
+            questions_list = [dict(question) for question in questions]
 
-            totalQuestions = len(Question.query.all())
+            totalQuestions = Question.query.count()
 
             return jsonify({
                 "success": True,
@@ -149,19 +295,28 @@ def create_app(test_config=None):
         else:
             # else add a new question
             # Check for errors with the submission
-            if (content['question'].strip() == "") \
-                    or (content['answer'].strip() == ""):
+            question = content.get('question') or ''
+            answer = content.get('answer') or ''
+            if not isinstance(question, str) or not isinstance(answer, str):
+                abort(400)
+            question = question.strip()
+            answer = answer.strip()
+            category = content.get('category')
+            difficulty = content.get('difficulty')
+            if not question or not answer \
+                    or category is None or difficulty is None:
                 # if parameters of the question aren't specified,
                 # we don't create new question
-                abort(400, "empty question or answer")
+                abort(400, "missing question parameters")
 
             try:
-                new_question = Question(content['question'],
-                                        content['answer'],
-                                        content['category'],
-                                        content['difficulty'])
+                new_question = Question(question,
+                                        answer,
+                                        category,
+                                        difficulty)
                 new_question.insert()
-            except:
+            except SQLAlchemyError:
+                db.session.rollback()
                 abort(422)
 
             return jsonify({
@@ -178,8 +333,9 @@ def create_app(test_config=None):
     '''
     @app.route('/api/categories/<int:category_id>/questions', methods=['GET'])
     def get_questions_by_category(category_id):
-        questions = Question.query.filter_by(category=str(category_id)).all()
-        current_questions = paginate_questions(request, questions)
+        current_questions, _ = paginate_questions(request,
+                                                  _CATEGORY_PAGE_STMT,
+                                                  {'category': category_id})
 
         if len(current_questions) == 0:
             abort(404)
@@ -204,37 +360,50 @@ def create_app(test_config=None):
 
     @app.route('/api/quizzes', methods=['POST'])
     def add_quiz():
-        content = request.get_json()
+        content = request.get_json(silent=True) or {}
+        if not isinstance(content, dict):
+            abort(400)
+        previousQuestions = content.get('previous_questions') or []
+        # previous questions must be a list of integer ids (bool is
+        # an int subclass, so it is excluded explicitly)
+        if not isinstance(previousQuestions, list) or not all(
+                isinstance(question_id, int)
+                and not isinstance(question_id, bool)
+                for question_id in previousQuestions):
+            abort(400)
+        # long quiz sessions repeat ids, keep each one once
+        # so the anti-join list stays as short as possible
+        previousQuestions = set(previousQuestions)
 
-        if 'previous_questions' in content:
-            previousQuestions = content['previous_questions']
+        quiz_category = content.get('quiz_category')
+        if isinstance(quiz_category, dict):
+            quiz_category = quiz_category.get('id')
         else:
-            previousQuestions = []
-
-        try:
-            quiz_category = content['quiz_category']['id']
-        except:
-            # Category must be supplied in this format
+            quiz_category = None
+        if not isinstance(quiz_category, int) \
+                or isinstance(quiz_category, bool):
+            # Category must be supplied in this format,
+            # with an integer id (0 for all categories)
             abort(400)
 
-        if quiz_category == 0:
-            questions = Question.query \
-              .filter(Question.id.notin_(previousQuestions)) \
-              .all()
-        else:
-            questions = Question.query\
-              .filter(Question.category == str(quiz_category),
-                      Question.id.notin_(previousQuestions))\
-              .all()
-        if len(questions) == 0:
+        questions = exclude_previous_questions(select(*_QUESTION_COLS),
+                                               previousQuestions)
+        if quiz_category != 0:
+            questions = questions \
+              .where(Question.category == quiz_category)
+
+        # let the database pick the random question,
+        # so only one row is transferred and formatted
+        question = db.session.execute(
+            questions.order_by(func.random()).limit(1)).mappings().first()
+        if question is None:
             return jsonify({
                 "success": True
             })
 
-        question = random.choice([question.format() for question in questions])
         return jsonify({
             "success": True,
-            "question": question
+            "question": dict(question)
         })
 
     '''
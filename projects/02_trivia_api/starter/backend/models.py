@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, DDL, create_engine, event
 from flask_sqlalchemy import SQLAlchemy
 
 
@@ -14,6 +14,15 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # one pool per process, sized for the worker threads serving requests
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        # keep compiled statements for all endpoints in the cache
+        "query_cache_size": 1200
+    })
     db.app = app
     db.init_app(app)
     db.create_all()
@@ -24,11 +33,19 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # category filters (questions by category, quizzes) use an index range scan
+  __table_args__ = (
+    db.Index('ix_question_category_id', 'category', 'id'),
+    # trigram index lets ILIKE '%term%' searches avoid a sequential scan
+    db.Index('ix_question_trgm', 'question',
+             postgresql_using='gin',
+             postgresql_ops={'question': 'gin_trgm_ops'}),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer)
   difficulty = Column(Integer)
 
   def __init__(self, question, answer, category, difficulty):
@@ -57,6 +74,10 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+event.listen(Question.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+             .execute_if(dialect='postgresql'))
+
 '''
 Category
 
@@ -1,11 +1,13 @@
 import os
 import unittest
 import json
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 
+import flaskr
 from flaskr import create_app
 from models import setup_db, Question, Category, db
-from sqlalchemy import func
+from sqlalchemy import event, func, select
 from sqlalchemy.sql import text as sa_text
 
 
@@ -54,6 +56,53 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['categories']), 6)
 
+    def test_get_categories_not_modified(self):
+        """Gets the /api/categories endpoint with the ETag of a previous
+        response, should return 304 without a body"""
+        res = self.client().get('/api/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/api/categories',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+
+    def test_get_categories_not_modified_compressed_etag(self):
+        """Gets the /api/categories endpoint with the ETag of a compressed
+        response (suffixed with the algorithm), should return 304"""
+        res = self.client().get('/api/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/api/categories',
+                                headers={'If-None-Match': etag[:-1] + ':br"'})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_categories_refreshes_expired_cache(self):
+        """Test that a renamed category is served once the cached
+        categories expire, although the table signature didn't change"""
+        def rename_category():
+            # the session is removed after every request,
+            # so the flushed rename only lasts for the next one
+            db.session.query(Category).filter(Category.id == 1) \
+                .update({'type': 'Physics'})
+            db.session.flush()
+
+        self.client().get('/api/categories')
+        rename_category()
+        res = self.client().get('/api/categories')
+        types = {category['id']: category['type']
+                 for category in json.loads(res.data)['categories']}
+        self.assertEqual(types[1], 'Science')
+
+        rename_category()
+        with mock.patch('flaskr.CATEGORIES_MAX_AGE', 0):
+            res = self.client().get('/api/categories')
+        types = {category['id']: category['type']
+                 for category in json.loads(res.data)['categories']}
+        self.assertEqual(types[1], 'Physics')
+
+        db.session.rollback()
+        flaskr._categories_cache.clear()
+
     def test_404_get_categories_from_empty_table(self):
         """Test rising of 404 error if requested all categories from
         empty Category table
@@ -80,7 +129,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['categories']), 6)
         self.assertEqual(data['total_questions'], 19)
         self.assertEqual(len(data['questions']), 10)
-        self.assertEqual(data['questions'][0]['id'], 5)
+        # questions are paginated in order of id, trivia.psql stores
+        # them unordered (5, 9, 2, ...), so the first one is id 2
+        self.assertEqual(data['questions'][0]['id'], 2)
 
     def test_get_questions_paginated(self):
         """Test the pagination of questions, get questions for page 2"""
@@ -95,6 +146,51 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['questions']), 9)
         self.assertEqual(data['questions'][0]['id'], 15)
 
+    def test_get_all_questions_streamed(self):
+        """Test getting all questions at once with page=all,
+        the response is streamed instead of paginated"""
+        res = self.client().get('/api/questions?page=all')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['categories']), 6)
+        self.assertEqual(data['total_questions'], 19)
+        self.assertEqual(len(data['questions']), 19)
+        self.assertEqual(data['questions'][0]['id'], 2)
+
+    def test_get_questions_reads_categories_signature_with_page(self):
+        """Test that once categories are cached, a page of questions
+        doesn't need separate queries against the categories table"""
+        self.client().get('/api/questions')
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get('/api/questions')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(res.status_code, 200)
+        # the page, with the categories signature and the total count
+        self.assertEqual(len(statements), 1)
+
+    def test_only_paginated_questions_are_compressed(self):
+        """Test that a page of questions is brotli compressed,
+        while the streamed list of all questions is sent as is"""
+        res = self.client().get('/api/questions',
+                                headers={'Accept-Encoding': 'br'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('Content-Encoding'), 'br')
+
+        res = self.client().get('/api/questions?page=all',
+                                headers={'Accept-Encoding': 'br'})
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+        self.assertEqual(len(json.loads(res.data)['questions']), 19)
+
     def test_404_get_questions_beyond_valid_page(self):
         """ Test rising of 404 error if requested page of questions doesn't exist """
         res = self.client().get('/api/questions?page=1000')
@@ -132,6 +228,46 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'bed request')
         self.new_question["answer"] = "Etna"
 
+    def test_400_if_answer_parameter_is_missing(self):
+        """Test creating of a question without an answer key,
+         should return 400 error"""
+        res = self.client().post('/api/questions',
+                                 json={'question': 'what is the capital of Italy',
+                                       'category': '3',
+                                       'difficulty': '1'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bed request')
+
+    def test_400_if_question_parameter_is_not_a_string(self):
+        """Test creating of a question whose text is not a string,
+         should return 400 error"""
+        res = self.client().post('/api/questions',
+                                 json={'question': 5,
+                                       'answer': 'Rome',
+                                       'category': '3',
+                                       'difficulty': '1'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bed request')
+
+    def test_400_if_category_parameter_is_missing(self):
+        """Test creating of a question without a category key,
+         should return 400 error"""
+        res = self.client().post('/api/questions',
+                                 json={'question': 'what is the capital of Italy',
+                                       'answer': 'Rome',
+                                       'difficulty': '1'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bed request')
+
     def test_get_questions_containing_searchTerm(self):
         """Test searching for a term in questions.question"""
         res = self.client().post('/api/questions', json={'searchTerm': 'What'})
@@ -150,6 +286,17 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bed request')
 
+    def test_400_get_questions_containing_non_string_searchTerm(self):
+        """Test searching for a term which is not a string,
+        should return 400 error"""
+        for search_term in [['What'], None, 5]:
+            res = self.client().post('/api/questions',
+                                     json={'searchTerm': search_term})
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bed request')
+
     def test_delete_question(self):
         """Test deleting of the question with maximum id"""
         max_id = db.session.query(func.max(Question.id)).scalar()
@@ -203,6 +350,18 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['question']['id'] in [12, 23])
 
+    def test_previous_questions_keep_quiz_statement_cacheable(self):
+        """Test that the quiz statement excluding previous questions
+        has the same cache key whatever the number of previous questions,
+        so SQLAlchemy compiles it only once """
+        stmt = select(Question.id)
+        short_key = flaskr.exclude_previous_questions(
+            stmt, [5, 9])._generate_cache_key()
+        long_key = flaskr.exclude_previous_questions(
+            stmt, range(100, 70100))._generate_cache_key()
+        self.assertIsNotNone(short_key)
+        self.assertEqual(short_key, long_key)
+
     def test_quiz_is_over(self):
         """Test returns only a success status without a question
         if all questions from a given category belong to
@@ -255,6 +414,43 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bed request')
 
+    def test_400_if_category_is_not_an_object(self):
+        """Test creating of a quiz when category was sent as a plain value
+        instead of an object with an id, or its id isn't an integer """
+        for quiz_category in ["History", {"id": [1]}, {"id": "History"},
+                              {"id": True}]:
+            res = self.client().post('/api/quizzes', \
+                                     json={"previous_questions": [], \
+                                           "quiz_category": quiz_category})
+
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bed request')
+
+    def test_400_if_quiz_body_is_not_an_object(self):
+        """Test creating of a quiz when the request body is a JSON list """
+        res = self.client().post('/api/quizzes', json=[4])
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bed request')
+
+    def test_400_if_previous_questions_are_not_ids(self):
+        """Test creating of a quiz when previous questions are not
+        a list of integer ids """
+        quiz_category = {"type": "History", "id": 4}
+        for previous_questions in ["123", [5.9], [True], 5]:
+            res = self.client().post('/api/quizzes', \
+                                     json={"previous_questions": previous_questions, \
+                                           "quiz_category": quiz_category})
+
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bed request')
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()